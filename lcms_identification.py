@@ -1,14 +1,15 @@
-import numpy as np 
-import sqlite3 as sql 
-import pandas as pd 
 import subprocess
+import os
 import webbrowser
 import argparse 
-from time import sleep 
+from time import sleep, monotonic
 
 # Shortcut for readability
 run = lambda command: subprocess.run(command.split())
 
+# Results database, stored next to this script such that the webfront can be started from any directory
+RESULTS_DATABASE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results_database.db')
+
 # =======================================================================================================
 def MSpeak_target_compound_identification(peaklist_csv_file, database_db_file, default_mass_tolerance=0.002, default_retime_tolerance=0.5):
 
@@ -24,38 +25,55 @@ def MSpeak_target_compound_identification(peaklist_csv_file, database_db_file, d
     default_mass_tolerance
         Default mass-to-charge ratio tolerance (Da) for assigning the LC-MS peaks. Defaults to 0.002.
     default_retime_tolerance
-        Default mass-to-charge ratio tolerance (Da) for assigning the LC-MS peaks. Defaults to 0.002.
+        Default retention time tolerance (minutes) for assigning the LC-MS peaks. Defaults to 0.5.
+
+    Returns
+    -------
+    results_database_file :: str
+        Path to the SQL database file containing the identified compounds, or None if no compounds were identified.
+
+    Notes
+    -----
+    The peaks are matched to the targets in single precision, such that peaks within ~1e-4 Da of the m/z 
+    tolerance boundary may be included or excluded differently than in double precision. The reported values 
+    and errors are computed from the double precision data.
     """
+    # Import the numerical libraries only here, such that the other actions start up quickly
+    import numpy as np 
+    import sqlite3 as sql 
+    import pandas as pd 
+    from contextlib import closing
+    from tolerance_join import tolerance_join
 
-    def distance_map(quantity):
-        return np.abs(np.atleast_2d(experimental[quantity]).T - np.atleast_2d(database[quantity]))
-
-    def connection_map_based_on(quantity):
-        return distance_map(quantity) < tolerance[quantity]
-
-    def peaks_ids(target_id):
-        return peak_target_matches[np.where(peak_target_matches[:,1]==target_id)[0]].flatten()[0]
-
-    def target_intensities(target):
-        return experimental['intensities'][peaks_ids(target)]
+    def sum_over_peaks(values):
+        return np.bincount(peak_target_matches[:,1], weights=values, minlength=len(database['m/z']))[identified_targets]
 
-    def average_over_peaks(value, target):
-        intensities = target_intensities(target)
-        return np.sum(value*intensities/np.sum(intensities))
+    def average_over_peaks(values):
+        return sum_over_peaks(values*matched_intensities)/intensities_per_target
 
-    def experimental_value_of_target(quantity,target_id):
-        return average_over_peaks(experimental[quantity][peaks_ids(target_id)], target_id)
+    def experimental_values_of_targets(quantity):
+        return average_over_peaks(experimental[quantity][peak_target_matches[:,0]])
 
-    def experimental_error_of_target(quantity,target_id):
-        experimental[quantity][peaks_ids(target_id)]
-        errors = np.abs(experimental[quantity][peaks_ids(target_id)] - database[quantity][target_id])
+    def experimental_errors_of_targets(quantity):
+        errors = np.abs(experimental[quantity][peak_target_matches[:,0]] - database[quantity][peak_target_matches[:,1]])
         if quantity=='m/z':
-            errors = errors*1e6/database['m/z'][target_id]
-        return average_over_peaks(errors, target_id)
-      
-    # Connect and retrieve target compound database
-    con = sql.connect(database_db_file)
-    targets_database = pd.read_sql_query("SELECT * FROM compoundlist",con)
+            errors = errors*1e6/database['m/z'][peak_target_matches[:,1]]
+        return average_over_peaks(errors)
+
+    # Catch retention time tolerances passed as mass tolerances, which would match nearly every peak to every target
+    if default_mass_tolerance >= 1.0:
+        raise ValueError(f'The mass tolerance ({default_mass_tolerance} Da) must be smaller than 1 Da.')
+
+    # Connect and retrieve the numerical data and labels of the target compound database (closing the connection afterwards)
+    with closing(sql.connect(database_db_file)) as con:
+        # Read the database through memory-mapped I/O (up to 256 MB) with a 64 MB page cache
+        con.execute('PRAGMA mmap_size=268435456')
+        con.execute('PRAGMA cache_size=-65536')
+        con.execute('PRAGMA temp_store=MEMORY')
+        # (the retention time tolerances are stored as text, they are converted by NumPy which rejects non-numeric values)
+        targets_data = con.execute("SELECT mass_to_charge_ratio, retention_time, retention_time_tolerance, retention_time IS NULL FROM compoundlist ORDER BY rowid").fetchall()
+        # The labels are only used for the output, they are kept as a list of rows until then
+        targets_labels = con.execute("SELECT compound_id, compound FROM compoundlist ORDER BY rowid").fetchall()
 
     # Load the list of MS-peaks
     peaklist = pd.read_csv(peaklist_csv_file)
@@ -63,12 +81,9 @@ def MSpeak_target_compound_identification(peaklist_csv_file, database_db_file, d
     # Data preparation
     # -----------------------------------------------------------------------------------------------------------
 
-    database_labels = ['mass_to_charge_ratio','retention_time','retention_time_tolerance']
-    newlabels = ['m/z','retime','retime_tolerance']
-    database = {f'{newlabel}' : targets_database[label].to_numpy() for newlabel,label in zip(newlabels,database_labels) }
-
-    # Convert None to np.nan
-    database['retime_tolerance'] = database['retime_tolerance'].astype(float)
+    # Store the database rows in a single structured array (converting None to np.nan), such that the data 
+    # of each target needed for the matching is stored contiguously
+    database = np.array(targets_data, dtype=[('m/z','f8'), ('retime','f8'), ('retime_tolerance','f8'), ('retime_unknown','?')])
 
     # Extract ndarrays from the peaklist dataframe
     csv_labels = ['mz','rt','intensity']
@@ -87,25 +102,35 @@ def MSpeak_target_compound_identification(peaklist_csv_file, database_db_file, d
     # Analysis
     # -----------------------------------------------------------------------------------------------------------
 
-    # Create a connection map for each quantity
-    connection_map  = {label : connection_map_based_on(label) for label in ['m/z','retime'] }
+    # Sort the targets by m/z once, such that the candidates of each peak can be found by binary search
+    targets_order = np.argsort(database['m/z'], kind='stable')
+    # Use single precision copies for the matching of the m/z and retention times
+    sorted_targets = database[targets_order].astype([('m/z','f4'), ('retime','f4'), ('retime_tolerance','f4'), ('retime_unknown','?')])
+    peaks = {label : experimental[label].astype(np.float32) for label in ['m/z','retime']}
 
-    # Include those targets whose retention times are not known
-    connection_map['retime'] = connection_map['retime'] | np.isnan(distance_map('retime'))
-    
     # Find the peaks that match to the targets
-    peak_target_matches = np.array( np.where( connection_map['m/z'] & connection_map['retime'] ) ).T
+    peak_target_matches = tolerance_join(peaks['m/z'], peaks['retime'], sorted_targets, targets_order, np.float32(tolerance['m/z']))
+
+    # Stop if no peaks match any of the targets
+    if len(peak_target_matches) == 0:
+        print('No compounds identified.')
+        return None
 
-    # Find the targets that have been identified
-    identified_targets, peaks_per_target = np.unique(peak_target_matches[:,1], return_counts=True)
+    # Count the peaks matched to each target and find the targets that have been identified
+    peaks_per_target = np.bincount(peak_target_matches[:,1], minlength=len(database['m/z']))
+    identified_targets = np.flatnonzero(peaks_per_target)
+    peaks_per_target = peaks_per_target[identified_targets]
+
+    # Gather the intensities of the matched peaks once and sum them for each identified target
+    matched_intensities = experimental['intensities'][peak_target_matches[:,0]]
+    intensities_per_target = sum_over_peaks(matched_intensities)
 
     # Calculate the total intensity for each identified target and normalize it to a value in parts-per-million
-    total_intensities = [np.sum(target_intensities(target_id)) for target_id in identified_targets]
-    total_intensities = total_intensities/np.sum(experimental['intensities'])*1e6
+    total_intensities = intensities_per_target/np.sum(experimental['intensities'])*1e6
 
     # Calculate the experimental values and errors for each identified compound
-    compounds_values = { label: [experimental_value_of_target(label,target_id) for target_id in identified_targets] for label in ['m/z','retime'] }
-    compounds_errors = { label: [experimental_error_of_target(label,target_id) for target_id in identified_targets] for label in ['m/z','retime'] }
+    compounds_values = { label: experimental_values_of_targets(label) for label in ['m/z','retime'] }
+    compounds_errors = { label: experimental_errors_of_targets(label) for label in ['m/z','retime'] }
 
     # Print the number of identified target compounds
     print(f'Identified {len(identified_targets)} target compounds.')
@@ -113,33 +138,70 @@ def MSpeak_target_compound_identification(peaklist_csv_file, database_db_file, d
     # Output
     # -----------------------------------------------------------------------------------------------------------
 
-    # Create a dataframe with identified targets data
+    # Retrieve the labels of the identified target compounds
+    compound_ids, compound_names = np.array(targets_labels, dtype=object).reshape(-1,2)[identified_targets].T
+
+    # Create a dataframe with identified targets data (indexed by their position in the target compound database)
     identified_targets_database = pd.DataFrame({
-        'Compound ID' : targets_database.compound_id.loc[identified_targets],
-        'Compound name' : targets_database.compound[identified_targets],
-        'Total intensity (ppm)' : np.round(total_intensities).astype(int),
+        'Compound ID' : compound_ids,
+        'Compound name' : pd.Categorical(compound_names),
+        'Total intensity (ppm)' : np.rint(total_intensities).astype(np.int32),
         'm/z (Da)' : np.round(compounds_values['m/z'],2),
-        'm/z error (ppm)' :  np.round(compounds_errors['m/z']).astype(int),
+        'm/z error (ppm)' :  np.rint(compounds_errors['m/z']).astype(np.int32),
         'Ret. time (min)' :  np.round(compounds_values['retime'],2),
         'Ret. time error (min)' :  np.round(compounds_errors['retime'],2),
         'Peaks within tolerance' :  peaks_per_target
-    })
+    }, index=identified_targets, copy=False)
     # Sort identified targets dataframe by Total intensity (ppm) in descending order
     identified_targets_database = identified_targets_database.sort_values('Total intensity (ppm)',ascending=False)
     # Reset index of identified targets dataframe
     identified_targets_database = identified_targets_database.reset_index()
 
-    # Define output name and connect to the database
-    connection_results = sql.connect(f'results_database.db') 
-    # Export identified compounds dataframe to the SQLite database
-    identified_targets_database.to_sql('Compounds identified by LC-MS', connection_results, if_exists='replace')
+    # Define the columns of the output table (the position in the sorted table is exported as 'level_0')
+    column_types = {'level_0' : 'INTEGER', 'index' : 'INTEGER', 'Compound ID' : 'INTEGER', 'Compound name' : 'TEXT', 
+                    'Total intensity (ppm)' : 'INTEGER', 'm/z (Da)' : 'REAL', 'm/z error (ppm)' : 'INTEGER', 
+                    'Ret. time (min)' : 'REAL', 'Ret. time error (min)' : 'REAL', 'Peaks within tolerance' : 'INTEGER'}
+    columns_definition = ', '.join(f'"{column}" {column_type}' for column,column_type in column_types.items())
+    rows = zip(identified_targets_database.index.tolist(), *[identified_targets_database[column].tolist() for column in identified_targets_database.columns])
+
+    # Define output name and connect to the database (transactions are handled explicitly)
+    results_database_file = RESULTS_DATABASE_FILE
+    with closing(sql.connect(results_database_file, isolation_level=None)) as connection_results:
+        connection_results.execute('PRAGMA synchronous=NORMAL')
+        # Export identified compounds to the SQLite database in a single transaction (keeping the previous table if it fails)
+        connection_results.execute('BEGIN')
+        try:
+            connection_results.execute('DROP TABLE IF EXISTS "Compounds identified by LC-MS"')
+            connection_results.execute(f'CREATE TABLE "Compounds identified by LC-MS" ({columns_definition})')
+            connection_results.executemany(f'INSERT INTO "Compounds identified by LC-MS" VALUES ({", ".join("?"*len(column_types))})', rows)
+        except BaseException:
+            connection_results.execute('ROLLBACK')
+            raise
+        connection_results.execute('COMMIT')
+
+    return results_database_file
+# =======================================================================================================
+
+# =======================================================================================================
+def build_datasette_webfront_image(rebuild=False):
+    """
+    Builds the Docker image of the Datasette web front, unless it already exists.
+
+    Parameters
+    ----------
+    rebuild :: bool
+        Whether to rebuild the image even if it already exists. Defaults to False.
+    """
+    # Check whether the image has already been built
+    image_exists = subprocess.run('docker image inspect datasette-web-front'.split(), capture_output=True).returncode == 0
 
     # Build Docker image
-    run('docker build -f .\Dockerfile . -t datasette-web-front')    
+    if rebuild or not image_exists:
+        run('docker build -f ./Dockerfile . -t datasette-web-front')
 # =======================================================================================================
 
 # =======================================================================================================
-def serve_datasette_webfront(port):
+def serve_datasette_webfront(port, results_database_file=RESULTS_DATABASE_FILE, timeout=10):
     """
     Starts a Datasette web front server in a Docker container on the specified port.
 
@@ -147,20 +209,37 @@ def serve_datasette_webfront(port):
     ----------
     port :: int
         The port number to use for the web front server.
+    results_database_file :: str
+        Path to the SQL database file containing the identified compounds. Defaults to the 'results_database.db' file next to this script.
+    timeout :: float
+        Maximal time (s) to wait for the web front server to be accessible. Defaults to 10s.
     """
-    # Stop container service if still running from a previous execution
-    run('docker stop datasette-web-front-service')
-    # Replace existing container (if exists)
-    run('docker rm datasette-web-front-service')
-    # Create new container and start the web front server 
-    run(f'docker run --name datasette-web-front-service -d -p {port}:8080 datasette-web-front')
-
-    # Wait for some seconds for the webfront to be accessible
-    sleep(3)
+    from urllib.request import urlopen
+
+    # The results database must exist, otherwise there is nothing to mount into the container
+    if not os.path.isfile(results_database_file):
+        raise FileNotFoundError(f"The results database {results_database_file} does not exist. Run the 'generate' action first.")
+
+    # Stop and replace the container service if still running from a previous execution
+    run('docker rm -f datasette-web-front-service')
+    # Create new container with the results database mounted and start the web front server 
+    results_database = os.path.abspath(results_database_file)
+    subprocess.run(['docker', 'run', '--name', 'datasette-web-front-service', '-d', '-p', f'{port}:8080', 
+                    '--mount', f'type=bind,source={results_database},target=/results_database.db', 'datasette-web-front'])
+
+    # Wait until the webfront is accessible
+    start = monotonic()
+    while monotonic() - start < timeout:
+        try:
+            with urlopen(f'http://localhost:{port}/-/versions', timeout=1):
+                return
+        except OSError:
+            sleep(0.05)
+    print(f'The Datasette webfront did not respond within {timeout}s.')
 # =======================================================================================================
 
 # =======================================================================================================
-def connect_to_datasette_webfront(port):
+def connect_to_datasette_webfront(port, results_database_file=RESULTS_DATABASE_FILE):
     """
     Opens a web browser to a specific Datasette URL with predefined options.
 
@@ -168,9 +247,11 @@ def connect_to_datasette_webfront(port):
     ----------
     port :: int
         The port number of the running Datasette web front server.
+    results_database_file :: str
+        Path to the SQL database file containing the identified compounds. Defaults to the 'results_database.db' file next to this script.
     """
     # Start the webfront
-    serve_datasette_webfront(port) 
+    serve_datasette_webfront(port, results_database_file) 
 
     # Set base URL for the database and define Datasette options
     base_url = f"http://localhost:{port}/results_database/Compounds+identified+by+LC-MS"
@@ -185,7 +266,7 @@ def connect_to_datasette_webfront(port):
 
 
 # =======================================================================================================
-def download_from_datasette_webfront(port):
+def download_from_datasette_webfront(port, results_database_file=RESULTS_DATABASE_FILE):
     """
     Downloads a CSV file from a Datasette web front server to the local machine.
 
@@ -193,14 +274,17 @@ def download_from_datasette_webfront(port):
     ----------
     port :: int
         The port number of the running Datasette web front server.
+    results_database_file :: str
+        Path to the SQL database file containing the identified compounds. Defaults to the 'results_database.db' file next to this script.
     """
     # Start the webfront
-    serve_datasette_webfront(port) 
+    serve_datasette_webfront(port, results_database_file) 
 
     # Set URL for downloading the CSV from Datasette
     download_url = f"http://localhost:{port}/results_database/Compounds+identified+by+LC-MS.csv"
 
     # Download
+    import pandas as pd 
     df = pd.read_csv(download_url)   
     df.to_csv('Compounds_identified_by_LC-MS.csv')
 # =======================================================================================================
@@ -220,21 +304,30 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--port", type=int, default=8080, nargs='?', help="Port on which to open connection to Datasette webfront. Defaults to port 8080.")
     parser.add_argument("-m", "--mass-tolerance", type=float, default=0.002, nargs='?', help="Default mass-to-charge ratio tolerance (Da) for assigning the LC-MS peaks. Defaults to 0.002.")
     parser.add_argument("-t", "--time-tolerance", type=float, default=0.5, nargs='?', help="Default retention time tolerance (minutes) for assigning the LC-MS peaks. Defaults to 0.5min.")
+    parser.add_argument("--rebuild-image", action='store_true', help="Rebuild the Datasette webfront Docker image even if it already exists. Only used for action='generate'.")
     args = parser.parse_args()
 
     # For the 'generate' action, the filenames are required
     if args.action == 'generate' and not (args.peaklist_file and args.database_file):
         raise SyntaxError('To generate the webfront you must specify the --peaklist-file and --database-file arguments.')
 
+    # By default, serve the results of the last analysis
+    results_database_file = RESULTS_DATABASE_FILE
+
     # Analyze the data and create the Datasette webfront image
     if args.action == 'generate':
         # Launch analysis
-        MSpeak_target_compound_identification(args.peaklist_file,args.database_file, default_retime_tolerance=args.mass_tolerance, default_mass_tolerance=args.time_tolerance)
+        results_database_file = MSpeak_target_compound_identification(args.peaklist_file,args.database_file, default_mass_tolerance=args.mass_tolerance, default_retime_tolerance=args.time_tolerance)
+        # Stop if no compounds were identified, there are no results to visualize
+        if results_database_file is None:
+            raise SystemExit()
+        # Build the Datasette webfront image (if needed)
+        build_datasette_webfront_image(rebuild=args.rebuild_image)
 
     # Connect to or download from the Datasette webfront
     if args.action == 'generate' or args.action == 'connect' :
         # Start web-front server with Datasette 
-        connect_to_datasette_webfront(args.port)
+        connect_to_datasette_webfront(args.port, results_database_file)
     else: 
         # Download the data directly from datasette
-        download_from_datasette_webfront(args.port)
+        download_from_datasette_webfront(args.port, results_database_file)
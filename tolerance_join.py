@@ -0,0 +1,116 @@
+import numpy as np 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Numba is optional, the peak matching falls back to NumPy if it is not installed
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# =======================================================================================================
+def _tolerance_join_numpy(peaks_mz, peaks_retime, sorted_targets, targets_order, mass_tolerance):
+    """
+    Find the pairs of MS peaks and target compounds within the m/z and retention time tolerances.
+
+    Parameters
+    ----------
+    peaks_mz, peaks_retime :: ndarray
+        Mass-to-charge ratios and retention times of the MS peaks.
+    sorted_targets :: ndarray
+        Structured array of the targets sorted by m/z, with the fields 'm/z', 'retime', 'retime_tolerance' 
+        and 'retime_unknown' (whether the retention time of the target is not known).
+    targets_order :: ndarray
+        Indices sorting the targets by m/z.
+    mass_tolerance :: float
+        Mass-to-charge ratio tolerance (Da).
+
+    Returns
+    -------
+    peak_target_matches :: ndarray
+        Array of shape (N_matches,2) with the indices of the matched peaks and (unsorted) targets.
+    """
+    # Find the range of (sorted) targets within the m/z tolerance of each peak
+    lower = np.searchsorted(sorted_targets['m/z'], peaks_mz - mass_tolerance, side='right')
+    upper = np.searchsorted(sorted_targets['m/z'], peaks_mz + mass_tolerance, side='left')
+    candidates_per_peak = np.maximum(upper - lower, 0)
+
+    # Expand the ranges into a flat list of candidate (peak, sorted target) pairs
+    candidate_peaks = np.repeat(np.arange(len(peaks_mz)), candidates_per_peak)
+    candidate_targets = np.repeat(lower - np.cumsum(candidates_per_peak) + candidates_per_peak, candidates_per_peak)
+    candidate_targets += np.arange(len(candidate_peaks))
+    candidates = sorted_targets[candidate_targets]
+
+    # Check the retention time only for the candidates, including those targets whose retention times are not known
+    # (computed in-place to avoid allocating a temporary array at each step)
+    retime_distance = peaks_retime[candidate_peaks]
+    np.subtract(retime_distance, candidates['retime'], out=retime_distance)
+    np.abs(retime_distance, out=retime_distance)
+    within_retime_tolerance = np.less(retime_distance, candidates['retime_tolerance'])
+    np.logical_or(within_retime_tolerance, candidates['retime_unknown'], out=within_retime_tolerance)
+
+    # Select the matching candidates before stacking them, mapping only those back to the unsorted targets
+    return np.column_stack((candidate_peaks[within_retime_tolerance], targets_order[candidate_targets[within_retime_tolerance]]))
+# =======================================================================================================
+
+# =======================================================================================================
+def _tolerance_join_threaded(peaks_mz, peaks_retime, sorted_targets, targets_order, mass_tolerance, min_peaks_per_chunk=10000):
+    """
+    Runs ``_tolerance_join_numpy`` in parallel threads over chunks of the MS peaks (NumPy releases the GIL).
+    Only large peak lists (at least ``min_peaks_per_chunk`` peaks per chunk) are split.
+    """
+    # Split the peaks into (at most) one chunk per CPU
+    number_of_chunks = max(1, min(os.cpu_count() or 1, len(peaks_mz)//min_peaks_per_chunk))
+    if number_of_chunks == 1:
+        return _tolerance_join_numpy(peaks_mz, peaks_retime, sorted_targets, targets_order, mass_tolerance)
+    chunks = np.linspace(0, len(peaks_mz), number_of_chunks+1).astype(int)
+
+    def join_chunk(start, stop):
+        matches = _tolerance_join_numpy(peaks_mz[start:stop], peaks_retime[start:stop], sorted_targets, targets_order, mass_tolerance)
+        # Shift the peak indices of the chunk back to the full peak list
+        matches[:,0] += start
+        return matches
+
+    with ThreadPoolExecutor(max_workers=number_of_chunks) as executor:
+        return np.concatenate(list(executor.map(join_chunk, chunks[:-1], chunks[1:])))
+# =======================================================================================================
+
+# =======================================================================================================
+if njit is not None:
+
+    @njit(cache=True)
+    def _within_retime_tolerance(peak_retime, target):
+        return target['retime_unknown'] or abs(peak_retime - target['retime']) < target['retime_tolerance']
+
+    @njit(parallel=True, cache=True)
+    def _tolerance_join_numba(peaks_mz, peaks_retime, sorted_targets, targets_order, mass_tolerance):
+        """
+        Numba-compiled equivalent of ``_tolerance_join_numpy``, streaming the peaks in parallel against the sorted targets.
+        """
+        # Find the range of (sorted) targets within the m/z tolerance of each peak
+        lower = np.searchsorted(sorted_targets['m/z'], peaks_mz - mass_tolerance, side='right')
+        upper = np.searchsorted(sorted_targets['m/z'], peaks_mz + mass_tolerance, side='left')
+
+        # First pass: count the matches of each peak
+        matches_per_peak = np.zeros(len(peaks_mz), dtype=np.int64)
+        for i in prange(len(peaks_mz)):
+            for k in range(lower[i], upper[i]):
+                if _within_retime_tolerance(peaks_retime[i], sorted_targets[k]):
+                    matches_per_peak[i] += 1
+
+        # Second pass: write the matches of each peak into its own slice of the output
+        ends = np.cumsum(matches_per_peak)
+        peak_target_matches = np.empty((ends[-1] if len(ends) else 0, 2), dtype=np.int64)
+        for i in prange(len(peaks_mz)):
+            j = ends[i] - matches_per_peak[i]
+            for k in range(lower[i], upper[i]):
+                if _within_retime_tolerance(peaks_retime[i], sorted_targets[k]):
+                    peak_target_matches[j,0] = i
+                    peak_target_matches[j,1] = targets_order[k]
+                    j += 1
+        return peak_target_matches
+
+    tolerance_join = _tolerance_join_numba
+else:
+    tolerance_join = _tolerance_join_threaded
+# =======================================================================================================